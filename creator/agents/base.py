@@ -1,27 +1,53 @@
 
 from typing import List, Dict, Any, Optional
 from threading import Thread
-import json
+import asyncio
+import weakref
 
 from langchain.chains import LLMChain
-from langchain.callbacks.manager import CallbackManager
+from langchain.callbacks.manager import CallbackManager, AsyncCallbackManager
 from langchain.tools.base import BaseTool
-from langchain.adapters.openai import convert_message_to_dict, convert_openai_messages
-from langchain.prompts import ChatPromptTemplate
-from langchain.output_parsers.json import parse_partial_json
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.schema.messages import FunctionMessage
+from langchain.schema.runnable import Runnable
 
-from creator.utils import get_user_info, ask_run_code_confirm, remove_tips
+from creator.utils import get_user_info, ask_run_code_confirm, remove_tips, dump_json, load_json, to_langchain_message, to_openai_message
 from creator.callbacks.buffer_manager import buffer_output_manager
+from creator.config.library import config
+
+
+def get_loop_local(registry: weakref.WeakKeyDictionary, factory):
+    # asyncio primitives bind to the loop that first waits on them, so keep one per running loop
+    loop = asyncio.get_running_loop()
+    if loop not in registry:
+        registry[loop] = factory()
+    return registry[loop]
+
+
+# shared by all agents so concurrent runs respect the llm rate limit
+llm_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    return get_loop_local(llm_semaphores, lambda: asyncio.Semaphore(config.max_concurrent_llm))
+
+
+# the tool result assumed while prefetching the next llm turn
+SPECULATIVE_TOOL_RESULT = {"status": "success", "stdout": "", "stderr": ""}
 
 
 class BaseAgent(LLMChain):
     total_tries: int = 1
     tools: List[BaseTool] = []
     function_schemas: List[dict] = []
+    # llm bound to function_schemas once at creation, the schemas never change afterwards
+    bound_llm: Optional[Runnable] = None
     output_key: str = "messages"
     system_template: str = ""
     allow_user_confirm: bool = False
+    speculative_prefetch: bool = config.speculative_prefetch
+    speculative_hits: int = 0
+    speculative_misses: int = 0
     prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages(messages=["system", ""])
 
     @property
@@ -32,13 +58,18 @@ class BaseAgent(LLMChain):
     def input_keys(self) -> List[str]:
         return ["messages"]
 
-    def construct_prompt(self, langchain_messages: Dict[str, Any]):
+    def construct_prompt(self):
         prompt = ChatPromptTemplate.from_messages(messages=[
             ("system", self.system_template + get_user_info()),
-            *langchain_messages
+            MessagesPlaceholder(variable_name="langchain_messages")
         ])
         return prompt
 
+    def get_llm_with_functions(self):
+        if self.bound_llm is None:
+            return self.llm.bind(functions=self.function_schemas)
+        return self.bound_llm
+
     def get_callbacks(self):
         callbacks = []
         if self.llm.callbacks is not None:
@@ -67,23 +98,37 @@ class BaseAgent(LLMChain):
 
     def tool_result_to_str(self, tool_result) -> str:
         if isinstance(tool_result, dict):
-            return json.dumps(tool_result, ensure_ascii=False)
+            return dump_json(tool_result)
         return str(tool_result)
 
-    def run_tool(self, function_call: Dict[str, Any]):
-        function_name = function_call.get("name", "")
-        arguments = parse_partial_json(function_call.get("arguments", "{}"))
-        tool_result = None
+    def find_tool(self, function_name: str) -> Optional[BaseTool]:
         for tool in self.tools:
             if tool.name == function_name:
-                if self.human_confirm():
-                    tool_result = tool.run(arguments)
-                    tool_result = self.tool_result_to_str(tool_result)
-                    tool_result = FunctionMessage(name=function_name, content=tool_result)
-                    self.update_tool_result_in_callbacks(tool_result)
-                break
+                return tool
+        return None
+
+    def tool_result_to_message(self, function_name: str, tool_result) -> FunctionMessage:
+        tool_result = FunctionMessage(name=function_name, content=self.tool_result_to_str(tool_result))
+        self.update_tool_result_in_callbacks(tool_result)
         return tool_result
 
+    def run_tool(self, function_call: Dict[str, Any]):
+        function_name = function_call.get("name", "")
+        tool = self.find_tool(function_name)
+        if tool is None or not self.human_confirm():
+            return None
+        tool_result = tool.run(load_json(function_call.get("arguments", "{}")))
+        return self.tool_result_to_message(function_name, tool_result)
+
+    async def arun_tool(self, function_call: Dict[str, Any]):
+        function_name = function_call.get("name", "")
+        tool = self.find_tool(function_name)
+        # the confirm prompt and the tools block, keep them off the event loop
+        if tool is None or not await asyncio.to_thread(self.human_confirm):
+            return None
+        tool_result = await asyncio.to_thread(tool.run, load_json(function_call.get("arguments", "{}")))
+        return self.tool_result_to_message(function_name, tool_result)
+
     def human_confirm(self):
         can_run_tool = True
         if self.allow_user_confirm:
@@ -96,18 +141,31 @@ class BaseAgent(LLMChain):
     def preprocess_inputs(self, inputs: Dict[str, Any]):
         return inputs
 
-    def run_workflow(self, inputs: Dict[str, Any], run_manager: Optional[CallbackManager] = None) -> Dict[str, Any]:
+    def start_workflow(self, inputs: Dict[str, Any]):
         inputs = self.preprocess_inputs(inputs)
         messages = inputs.pop("messages")
-        langchain_messages = convert_openai_messages(messages)
-        llm_with_functions = self.llm.bind(functions=self.function_schemas)
+        langchain_messages = list(map(to_langchain_message, messages))
+        # kept in sync with langchain_messages, minus the tips added by messages_hot_fix
+        openai_messages = list(map(to_openai_message, remove_tips(langchain_messages)))
+        return inputs, langchain_messages, openai_messages
+
+    def add_message(self, message, langchain_messages, openai_messages):
+        langchain_messages.append(message)
+        openai_messages.append(to_openai_message(message))
+
+    def add_tool_result(self, tool_result: FunctionMessage, langchain_messages, openai_messages):
+        self.add_message(tool_result, langchain_messages, openai_messages)
+        return self.messages_hot_fix(langchain_messages)
+
+    def run_workflow(self, inputs: Dict[str, Any], run_manager: Optional[CallbackManager] = None) -> Dict[str, Any]:
+        inputs, langchain_messages, openai_messages = self.start_workflow(inputs)
+        prompt = self.construct_prompt()
+        llm_chain = prompt | self.get_llm_with_functions() | self.postprocess_mesasge
         current_try = 0
         while current_try < self.total_tries:
             self.start_callbacks()
-            prompt = self.construct_prompt(langchain_messages)
-            llm_chain = prompt | llm_with_functions | self.postprocess_mesasge
-            message = llm_chain.invoke(inputs)
-            langchain_messages.append(message)
+            message = llm_chain.invoke({**inputs, "langchain_messages": langchain_messages})
+            self.add_message(message, langchain_messages, openai_messages)
             function_call = message.additional_kwargs.get("function_call", None)
             if function_call is None:
                 self.end_callbacks(message)
@@ -117,14 +175,81 @@ class BaseAgent(LLMChain):
             if tool_result is None:
                 self.end_callbacks(message)
                 break
-            langchain_messages.append(tool_result)
-            langchain_messages = self.messages_hot_fix(langchain_messages)
+            langchain_messages = self.add_tool_result(tool_result, langchain_messages, openai_messages)
             current_try += 1
             self.end_callbacks(message)
-        langchain_messages = remove_tips(langchain_messages)
-        openai_messages = list(map(convert_message_to_dict, langchain_messages))
         return openai_messages
 
+    async def aspeculate_message(self, prompt, speculative_llm, langchain_messages, function_name, inputs):
+        # predict the prompt for a tool call that succeeds without output, callbacks are
+        # left out so a discarded prediction never reaches the streaming display
+        predicted_result = FunctionMessage(name=function_name, content=self.tool_result_to_str(SPECULATIVE_TOOL_RESULT))
+        predicted_messages = self.messages_hot_fix([*langchain_messages, predicted_result])
+        async with get_llm_semaphore():
+            message = await (prompt | speculative_llm).ainvoke({**inputs, "langchain_messages": predicted_messages})
+        return message
+
+    async def arun_workflow(self, inputs: Dict[str, Any], run_manager: Optional[AsyncCallbackManager] = None) -> Dict[str, Any]:
+        inputs, langchain_messages, openai_messages = self.start_workflow(inputs)
+        speculative_llm = None
+        if self.speculative_prefetch and not self.allow_user_confirm:
+            # tags and metadata are excluded fields, copy() would leave them unset
+            speculative_llm = self.llm.copy(update={
+                "callbacks": None, "callback_manager": None, "tags": self.llm.tags, "metadata": self.llm.metadata
+            })
+            speculative_llm = speculative_llm.bind(functions=self.function_schemas) | self.postprocess_mesasge
+        prompt = self.construct_prompt()
+        llm_chain = prompt | self.get_llm_with_functions() | self.postprocess_mesasge
+        speculative_task = None
+        current_try = 0
+        try:
+            while current_try < self.total_tries:
+                self.start_callbacks()
+                if speculative_task is not None:
+                    message = await speculative_task
+                    speculative_task = None
+                    self.speculative_hits += 1
+                else:
+                    async with get_llm_semaphore():
+                        message = await llm_chain.ainvoke({**inputs, "langchain_messages": langchain_messages})
+                self.add_message(message, langchain_messages, openai_messages)
+                function_call = message.additional_kwargs.get("function_call", None)
+                if function_call is None:
+                    self.end_callbacks(message)
+                    break
+
+                tool_task = asyncio.create_task(self.arun_tool(function_call))
+                # only worth a request when the tool runs and another turn follows it
+                if (
+                    speculative_llm is not None
+                    and current_try + 1 < self.total_tries
+                    and self.find_tool(function_call.get("name", "")) is not None
+                ):
+                    speculative_task = asyncio.create_task(self.aspeculate_message(
+                        prompt, speculative_llm, list(langchain_messages), function_call.get("name", ""), inputs
+                    ))
+                tool_result = await tool_task
+                if speculative_task is not None:
+                    speculative_task = self.check_speculation(speculative_task, tool_result)
+                if tool_result is None:
+                    self.end_callbacks(message)
+                    break
+                langchain_messages = self.add_tool_result(tool_result, langchain_messages, openai_messages)
+                current_try += 1
+                self.end_callbacks(message)
+        finally:
+            if speculative_task is not None:
+                speculative_task.cancel()
+        return openai_messages
+
+    def check_speculation(self, speculative_task, tool_result):
+        # the prediction is only usable when the real tool result produces the same prompt
+        if tool_result is not None and tool_result.content == self.tool_result_to_str(SPECULATIVE_TOOL_RESULT):
+            return speculative_task
+        speculative_task.cancel()
+        self.speculative_misses += 1
+        return None
+
     def parse_output(self, messages):
         return {"messages": messages}
 
@@ -142,6 +267,20 @@ class BaseAgent(LLMChain):
             raise e
         return output
 
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManager] = None,
+    ) -> Dict[str, Any]:
+        output = {self.output_key: None}
+        try:
+            messages = await self.arun_workflow(inputs, run_manager)
+            output = self.parse_output(messages)
+        except Exception as e:
+            self.error_callbacks(e)
+            raise e
+        return output
+
     def iter(self, inputs):
         output_queue = []
 
@@ -1,22 +1,23 @@
 
-import json
 from typing import Any, Dict
+import asyncio
+import weakref
 
-from langchain.output_parsers.json import parse_partial_json
-from langchain.prompts import ChatPromptTemplate
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.schema.messages import AIMessage, FunctionMessage, SystemMessage
 from langchain.schema.runnable import RunnableConfig
 
 from creator.code_interpreter.safe_python import SafePythonInterpreter
 from creator.config.library import config
-from creator.utils import load_system_prompt, get_user_info, remove_tips
+from creator.utils import load_system_prompt, get_user_info, remove_tips, dump_json, load_json
 from creator.llm.llm_creator import create_llm
 
-from .base import BaseAgent
+from .base import BaseAgent, get_loop_local
 
 
 OPEN_CREATOR_API_DOC = load_system_prompt(config.api_doc_path)
 VERIFY_TIPS = load_system_prompt(config.tips_for_veryfy_prompt_path)
+VERIFY_TIPS_MESSAGE = SystemMessage(content=VERIFY_TIPS)
 ALLOWED_FUNCTIONS = {"create", "save", "search", "CodeSkill"}
 ALLOW_METHODS = {".show", ".show_code", ".test", ".run", ".save", "__add__", "__gt__", "__lt__", "__annotations__"}
 IMPORT_CODE = (
@@ -29,6 +30,12 @@ IMPORT_CODE = (
 class CreatorAgent(BaseAgent):
     total_tries: int = 5
     allow_user_confirm: bool = config.run_human_confirm
+    # one lock per event loop, see ainvoke
+    run_locks: Any = None
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.run_locks = weakref.WeakKeyDictionary()
 
     @property
     def _chain_type(self):
@@ -38,34 +45,38 @@ class CreatorAgent(BaseAgent):
         inputs["OPEN_CREATOR_API_DOC"] = OPEN_CREATOR_API_DOC
         return inputs
 
-    def construct_prompt(self, langchain_messages: Dict[str, Any]):
+    def construct_prompt(self):
         prompt = ChatPromptTemplate.from_messages(messages=[
             ("system", self.system_template + get_user_info()),
             AIMessage(content="", additional_kwargs={"function_call": {"name": "python", "arguments": IMPORT_CODE}}),
             FunctionMessage(name="python",content="Environment setup done!"),
-            *langchain_messages
+            MessagesPlaceholder(variable_name="langchain_messages")
         ])
         return prompt
 
     def messages_hot_fix(self, langchain_messages):
         langchain_messages = remove_tips(langchain_messages)
-        langchain_messages.append(SystemMessage(content=VERIFY_TIPS))
+        langchain_messages.append(VERIFY_TIPS_MESSAGE)
         return langchain_messages
 
     def postprocess_mesasge(self, message):
         function_call = message.additional_kwargs.get("function_call", None)
         if function_call is not None:
-            arguments = parse_partial_json(function_call.get("arguments", "{}"))
+            arguments = load_json(function_call.get("arguments", "{}"))
             if arguments is None and function_call.get("arguments", None) is not None:
                 function_call = {
                     "name": "python",
-                    "arguments": json.dumps({"code": function_call.get("arguments")}, ensure_ascii=False)
+                    "arguments": dump_json({"code": function_call.get("arguments")})
                 }
                 message.additional_kwargs["function_call"] = function_call
         return message
 
     async def ainvoke(self, inputs: Dict[str, Any], config: RunnableConfig | None = None, **kwargs: Any) -> Dict[str, Any]:
-        return {"messages": self.run(inputs)}
+        # every session shares the python worker namespace and the output managers of this agent,
+        # so concurrent requests run one at a time until each session gets its own interpreter
+        async with get_loop_local(self.run_locks, asyncio.Lock):
+            outputs = await self.acall(inputs, return_only_outputs=True)
+        return {"messages": outputs[self.output_key]}
 
 
 def create_creator_agent(llm):
@@ -74,11 +85,14 @@ def create_creator_agent(llm):
     code_interpreter = SafePythonInterpreter(allowed_functions=ALLOWED_FUNCTIONS, allowed_methods=ALLOW_METHODS, redirect_output=True)
     code_interpreter.setup(IMPORT_CODE)
 
+    function_schema = code_interpreter.to_function_schema()
+
     chain = CreatorAgent(
         llm=llm,
         system_template=template,
         tools=[code_interpreter],
-        function_schemas=[code_interpreter.to_function_schema()],
+        function_schemas=[function_schema],
+        bound_llm=llm.bind(functions=[function_schema]),
         verbose=False,
     )
     return chain
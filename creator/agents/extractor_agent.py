@@ -1,5 +1,4 @@
-from typing import Dict, Any
-from langchain.prompts import ChatPromptTemplate
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.output_parsers.json import parse_partial_json
 
 from creator.config.library import config
@@ -17,9 +16,9 @@ class SkillExtractorAgent(BaseAgent):
     def _chain_type(self):
         return "SkillExtractorAgent"
 
-    def construct_prompt(self, langchain_messages: Dict[str, Any]):
+    def construct_prompt(self):
         prompt = ChatPromptTemplate.from_messages(messages=[
-            *langchain_messages,
+            MessagesPlaceholder(variable_name="langchain_messages"),
             ("system", self.system_template + get_user_info())
         ])
         return prompt
@@ -51,6 +50,7 @@ def create_skill_extractor_agent(llm):
         llm=llm,
         system_template=template,
         function_schemas=[function_schema],
+        bound_llm=llm.bind(functions=[function_schema]),
         verbose=False
     )
     return chain
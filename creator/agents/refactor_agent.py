@@ -1,8 +1,7 @@
-from typing import Any, Dict
 import json
 import os
 
-from langchain.prompts import ChatPromptTemplate
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.output_parsers.json import parse_partial_json
 
 from creator.config.library import config
@@ -19,9 +18,9 @@ class CodeRefactorAgent(BaseAgent):
     def _chain_type(self):
         return "CodeRefactorAgent"
 
-    def construct_prompt(self, langchain_messages: Dict[str, Any]):
+    def construct_prompt(self):
         prompt = ChatPromptTemplate.from_messages(messages=[
-            *langchain_messages,
+            MessagesPlaceholder(variable_name="langchain_messages"),
             ("system", self.system_template + get_user_info())
         ])
         return prompt
@@ -65,6 +64,7 @@ def create_code_refactor_agent(llm):
         llm=llm,
         system_template=template,
         function_schemas=[function_schema],
+        bound_llm=llm.bind(functions=[function_schema]),
         verbose=False
     )
     return chain
@@ -1,18 +1,19 @@
 import json
 
 from langchain.schema.messages import SystemMessage
-from langchain.output_parsers.json import parse_partial_json
 
 from creator.code_interpreter import CodeInterpreter, language_map
 from creator.config.library import config
-from creator.utils import load_system_prompt, remove_tips
+from creator.utils import load_system_prompt, remove_tips, dump_json, load_json, ERROR_PATTERN
 from creator.llm.llm_creator import create_llm
 
 from .base import BaseAgent
 
 
 DEBUGGING_TIPS = load_system_prompt(config.tips_for_testing_prompt_path)
+DEBUGGING_TIPS_MESSAGE = SystemMessage(content=DEBUGGING_TIPS)
 VERIFY_TIPS = load_system_prompt(config.tips_for_veryfy_prompt_path)
+VERIFY_TIPS_MESSAGE = SystemMessage(content=VERIFY_TIPS)
 
 
 class CodeTesterAgent(BaseAgent):
@@ -29,12 +30,12 @@ class CodeTesterAgent(BaseAgent):
         if function_call is not None:
             name = function_call.get("name", "run_code")
             arguments = function_call.get("arguments", "{}")
-            arguments_json = parse_partial_json(arguments)
+            arguments_json = load_json(arguments)
             if name not in ("run_code", "test_summary") or not arguments_json:
                 language = name if name in language_map else "python"
                 function_call = {
                     "name": "run_code",
-                    "arguments": json.dumps({"language": language, "code": arguments}, ensure_ascii=False)
+                    "arguments": dump_json({"language": language, "code": arguments})
                 }
                 message.additional_kwargs["function_call"] = function_call
         return message
@@ -42,11 +43,12 @@ class CodeTesterAgent(BaseAgent):
     def messages_hot_fix(self, langchain_messages):
         langchain_messages = remove_tips(langchain_messages)
         tool_result = langchain_messages[-1].content
-        tool_result = parse_partial_json(tool_result)
-        if len(tool_result.get("stderr", "")) > 0 and "error" in tool_result["stderr"].lower():  # add tips for debugging
-            langchain_messages.append(SystemMessage(content=DEBUGGING_TIPS))
+        tool_result = load_json(tool_result)
+        stderr = tool_result.get("stderr", "")
+        if stderr and ERROR_PATTERN.search(stderr):  # add tips for debugging
+            langchain_messages.append(DEBUGGING_TIPS_MESSAGE)
         else:
-            langchain_messages.append(SystemMessage(content=VERIFY_TIPS))
+            langchain_messages.append(VERIFY_TIPS_MESSAGE)
         return langchain_messages
 
     def parse_output(self, messages):
@@ -54,7 +56,7 @@ class CodeTesterAgent(BaseAgent):
         test_summary = None
         if function_call is not None:
             function_name = function_call.get("name", "")
-            arguments = parse_partial_json(function_call.get("arguments", "{}"))
+            arguments = load_json(function_call.get("arguments", "{}"))
             if function_name == "test_summary":
                 test_summary = arguments.get("test_cases", [])
                 messages = messages[:-1]
@@ -74,10 +76,12 @@ def create_code_tester_agent(llm):
     with open(config.testsummary_function_schema_path, encoding="utf-8") as f:
         test_summary_function_schema = json.load(f)
 
+    function_schemas = [code_interpreter_function_schema, test_summary_function_schema]
     chain = CodeTesterAgent(
         llm=llm,
         system_template=template,
-        function_schemas=[code_interpreter_function_schema, test_summary_function_schema],
+        function_schemas=function_schemas,
+        bound_llm=llm.bind(functions=function_schemas),
         tools=[tool],
         verbose=False,
     )
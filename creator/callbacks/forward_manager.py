@@ -0,0 +1,27 @@
+from .base import OutputManager
+
+
+class ForwardOutputManager(OutputManager):
+    """Stands in for an output manager inside the python worker and sends every call to the parent process."""
+
+    def __init__(self, connection, manager_name: str):
+        self.connection = connection
+        self.manager_name = manager_name
+
+    def forward(self, method: str, *args, **kwargs):
+        self.connection.send(("output", self.manager_name, method, args, kwargs))
+
+    def add(self, agent_name: str):
+        self.forward("add", agent_name)
+
+    def update(self, chunk):
+        self.forward("update", chunk)
+
+    def update_tool_result(self, chunk):
+        self.forward("update_tool_result", chunk)
+
+    def finish(self, message=None, err=None):
+        # exceptions may not pickle, the parent only needs their message
+        if err is not None:
+            err = RuntimeError(str(err))
+        self.forward("finish", message=message, err=err)
@@ -1,5 +1,5 @@
 from .applescript import AppleScriptInterpreter
-from .base import BaseInterpreter
+from .base import BaseInterpreter, ToolResult
 from .julia import JuliaInterpreter
 from .python import PythonInterpreter
 from .R import RInterpreter
@@ -24,7 +24,8 @@ __all__ = [
     'HTMLInterpreter',
     'JavascriptInterpreter',
     'ShellInterpreter',
-    "CodeInterpreter"
+    "CodeInterpreter",
+    "ToolResult"
 ]
 
 
@@ -72,7 +73,7 @@ class CodeInterpreter(StructuredTool):
         code: str,
         run_manager: Optional[CallbackManagerForToolRun] = None,
         **kwargs: Any,
-    ) -> dict[str, str]:
+    ) -> ToolResult:
         language = language.lower()
         if language not in language_map:
             return {"status": "error", "stdout": "", "stderr": f"Language {language} not supported, Only support {list(language_map.keys())}"}
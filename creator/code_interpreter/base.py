@@ -3,6 +3,15 @@ import traceback
 import threading
 import time
 import os
+from typing import TypedDict
+
+
+class ToolResult(TypedDict):
+    """The fixed shape every interpreter returns, it is json encoded as-is into the function message."""
+
+    status: str
+    stdout: str
+    stderr: str
 
 
 class BaseInterpreter:
@@ -74,7 +83,7 @@ class BaseInterpreter:
     def postprocess(self, output):
         return output
 
-    def run(self, query: str, is_start: bool = False) -> dict:
+    def run(self, query: str, is_start: bool = False) -> ToolResult:
         try:
             query = self.preprocess(query)
         except Exception:
@@ -1,13 +1,184 @@
 from langchain.tools import StructuredTool, format_tool_to_openai_function
 from langchain.callbacks.manager import CallbackManagerForToolRun
 from pydantic import BaseModel, Field
-from creator.utils import remove_title, split_code_blocks, is_expression
-from typing import Type, Optional
+from creator.utils import remove_title, split_code_blocks, compile_exec, try_compile_eval
+from .base import ToolResult
+from typing import Type, Optional, Any
+import multiprocessing
 import threading
+import functools
+import atexit
+import time
+from contextlib import redirect_stdout, nullcontext
 import traceback
+import builtins
+import orjson
 import ast
 import io
-import sys
+
+
+# node types are dispatched with set/identity checks on type(node) rather than isinstance chains
+DISALLOWED_NODE_TYPES = frozenset({ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef})
+
+# Restricted runs only see these builtins, so nothing can reach __import__, eval, open, getattr...
+SAFE_BUILTIN_NAMES = frozenset({
+    "abs", "all", "any", "bool", "dict", "divmod", "enumerate", "filter", "float", "format", "frozenset",
+    "hasattr", "hash", "int", "isinstance", "issubclass", "iter", "len", "list", "map", "max", "min", "next",
+    "print", "range", "repr", "reversed", "round", "set", "slice", "sorted", "str", "sum", "tuple", "zip",
+    "ArithmeticError", "AssertionError", "AttributeError", "Exception", "IndexError", "KeyError",
+    "NameError", "NotImplementedError", "RuntimeError", "StopIteration", "TypeError", "ValueError",
+    "ZeroDivisionError",
+})
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in SAFE_BUILTIN_NAMES}
+
+
+def check_nodes(tree: ast.AST, allowed_functions: frozenset, allowed_attrs: frozenset):
+    """Rejects definitions and calls that are neither allowed functions nor allowed methods."""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type in DISALLOWED_NODE_TYPES:
+            raise ValueError(f"Usage of {node_type.__name__} nodes is not allowed")
+        if node_type is ast.Call:
+            func = node.func
+            func_type = type(func)
+            if not (
+                (func_type is ast.Name and func.id in allowed_functions)
+                or (func_type is ast.Attribute and func.attr in allowed_attrs)
+            ):
+                raise ValueError("Usage of disallowed function/method: " + ast.unparse(node))
+        stack.extend(ast.iter_child_nodes(node))
+
+
+@functools.lru_cache(maxsize=256)
+def restrict_code(query: str, allowed_functions: frozenset, allowed_attrs: frozenset) -> str:
+    """Drop imports that would shadow allowed functions and reject any other import, definition or disallowed call.
+
+    Only passing code is cached.
+    """
+    tree = ast.parse(query)
+    new_body = []
+    for node in tree.body:
+        # Remove import nodes
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            new_body.append(node)
+        else:
+            # Check for disallowed imports
+            import_tokens = set(ast.unparse(node).split(" "))
+            # remove from, import, as
+            import_tokens = import_tokens.difference({"from", "import", "as", ""})
+            if len(import_tokens & allowed_functions) == 0:
+                new_body.append(node)
+    tree.body = new_body
+    check_nodes(tree, allowed_functions, allowed_attrs)
+    return ast.unparse(tree)
+
+
+class PythonExecutor:
+    """Runs code against a persistent namespace, owned by the worker process."""
+
+    def __init__(self, redirect_output: bool = True, max_output_chars: int = 100000, setup_code: str = ""):
+        self.namespace = {}
+        self.redirect_output = redirect_output
+        self.max_output_chars = max_output_chars
+        self.setup(setup_code)
+
+    def setup(self, setup_code: str = ""):
+        # one buffer reused by every run to capture print statements
+        self._out_buf = io.StringIO()
+        self.setup_error = ""
+        if setup_code:
+            result = self.run_code(setup_code)
+            if result["status"] == "error":
+                # kept for the first run, otherwise it only sees NameErrors for what the setup should define
+                self.setup_error = "The setup code failed:\n" + result["stderr"]
+
+    def capture_output(self):
+        return redirect_stdout(self._out_buf) if self.redirect_output else nullcontext()
+
+    def read_output(self):
+        if self._out_buf.tell() > self.max_output_chars:
+            # only keep the head like truncate_output, without copying the whole buffer into a string first
+            self._out_buf.seek(0)
+            printed_output = self._out_buf.read(self.max_output_chars) + "\n...[truncated]..."
+        else:
+            printed_output = self._out_buf.getvalue()
+        self._out_buf.seek(0)
+        self._out_buf.truncate(0)
+        return printed_output
+
+    def execute_last_line(self, last_line):
+        output = ""
+        with self.capture_output():
+            eval_code = try_compile_eval(last_line)
+            if eval_code is not None:
+                eval_output = eval(eval_code, self.namespace)
+                if eval_output is not None:
+                    output += str(eval_output)
+            else:
+                exec(compile_exec(last_line), self.namespace)
+        return output + self.read_output()
+
+    def execute_code_blocks(self, blocks):
+        # the blocks come from split_code_blocks and end on statement boundaries,
+        # so they run as one compiled module instead of one exec per block
+        with self.capture_output():
+            exec(compile_exec("\n".join(blocks)), self.namespace)
+        return self.read_output()
+
+    def run_code(self, query: str, restricted: bool = False) -> ToolResult:
+        # swapped per run, the restricted code only gets the safe builtins while the REPL keeps all of them
+        self.namespace["__builtins__"] = SAFE_BUILTINS if restricted else builtins.__dict__
+        output = ""
+        code_blocks = list(split_code_blocks(query))
+        last_line = code_blocks.pop(-1) if len(code_blocks) > 0 else ""
+        try:
+            if len(code_blocks) > 0:
+                output += self.execute_code_blocks(code_blocks)
+            if last_line:
+                output += self.execute_last_line(last_line)
+        except Exception:
+            return {"status": "error", "stdout": output + self.read_output(), "stderr": traceback.format_exc()}
+        return {"status": "success", "stdout": output, "stderr": ""}
+
+
+OUTPUT_MANAGER_NAMES = ("buffer_output_manager", "rich_output_manager", "file_output_manager")
+
+
+def run_executor(connection, redirect_output: bool, max_output_chars: int, setup_code: str):
+    # Worker process loop: receive code, run it and send back the orjson encoded result.
+    # Agents created by the code stream through the output managers, their calls are replayed by the parent.
+    # imported here, creator.callbacks imports the config which imports this module
+    from creator.callbacks import streaming_stdout
+    from creator.callbacks.forward_manager import ForwardOutputManager
+    for manager_name in OUTPUT_MANAGER_NAMES:
+        setattr(streaming_stdout, manager_name, ForwardOutputManager(connection, manager_name))
+    executor = PythonExecutor(redirect_output=redirect_output, max_output_chars=max_output_chars, setup_code=setup_code)
+    while True:
+        try:
+            query, restricted = connection.recv()
+        except EOFError:
+            break
+        result = executor.run_code(query, restricted)
+        if executor.setup_error:
+            result = {"status": "error", "stdout": result["stdout"], "stderr": executor.setup_error + result["stderr"]}
+            executor.setup_error = ""
+        connection.send(("result", encode_result(result)))
+
+
+def encode_result(result: ToolResult) -> bytes:
+    try:
+        return orjson.dumps(result)
+    except TypeError:
+        # orjson rejects lone surrogates (e.g., print('\udcff')), replace them rather than crash the worker
+        return orjson.dumps({key: value.encode("utf-8", "replace").decode("utf-8") for key, value in result.items()})
+
+
+def stop_process(process, connection):
+    process.terminate()
+    process.join()
+    connection.close()
 
 
 class PythonInput(BaseModel):
@@ -20,145 +191,106 @@ class SafePythonInterpreter(StructuredTool):
     args_schema: Type[BaseModel] = PythonInput
     namespace: dict = {}
     setup_done: bool = False
+    setup_code: str = ""
 
     allowed_functions: set = {}
     allowed_methods: set = {}
+    # frozen once in setup, they are the hashed lru_cache keys of restrict_code
+    frozen_functions: frozenset = frozenset()
+    frozen_attrs: frozenset = frozenset()
     timeout: float = 1200
     redirect_output: bool = True
+    max_output_chars: int = 100000
 
-    def setup(self, setup_code: str):
-        self.run_code(setup_code)
-        # allowed_functions add build-ins
-        self.allowed_functions |= set(self.namespace["__builtins__"].keys())
-        self.setup_done = True
+    # The code runs in a long-lived worker process holding the namespace, so a timed out run can be killed.
+    # The worker is spawned on first use, spawning it at import time would recurse through `import creator`.
+    worker: Any = None
+    connection: Any = None
+    worker_lock: Any = None
+    worker_cleanup: Any = None
 
-    def is_allowed_function(self, node):
-        # Check if the node represents a call to an allowed function
-        return (
-            isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in self.allowed_functions
-        )
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.worker_lock = threading.Lock()
 
-    def is_allowed_method(self, node):
-        # Check if the node represents a call to an allowed method of an allowed class
-        return (
-            isinstance(node, ast.Call) and any(allowed_method in ast.unparse(node.func) for allowed_method in self.allowed_methods)
-        )
+    def setup(self, setup_code: str):
+        # the setup code is replayed every time the worker is (re)started
+        self.setup_code = setup_code
+        # allowed_functions add the build-ins left in the worker namespace
+        self.allowed_functions |= SAFE_BUILTIN_NAMES
+        self.frozen_functions = frozenset(self.allowed_functions)
+        self.frozen_attrs = frozenset(method.lstrip(".") for method in self.allowed_methods)
+        self.setup_done = True
 
     def preprocess(self, query: str):
         try:
-            # Parse the code to an AST
-            tree = ast.parse(query)
-
             # If setup is done, restrict the allowed nodes
             if getattr(self, "setup_done", False):
-                new_body = []
-                for node in tree.body:
-                    # Remove import nodes
-                    if not isinstance(node, (ast.Import, ast.ImportFrom)):
-                        new_body.append(node)
-                    else:
-                        # Check for disallowed imports
-                        import_tokens = set(ast.unparse(node).split(" "))
-                        # remove from, import, as
-                        import_tokens = import_tokens.difference({"from", "import", "as", ""})
-                        if len(import_tokens & self.allowed_functions) == 0:
-                            new_body.append(node)
-                tree.body = new_body
-                for node in ast.walk(tree):
-                    # Check for unsafe nodes
-                    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
-                        raise ValueError(f"Usage of {node.__class__.__name__} nodes is not allowed")
-                    # Check for disallowed function/method calls
-                    elif isinstance(node, ast.Call):
-                        if not (self.is_allowed_function(node) or self.is_allowed_method(node)):
-                            raise ValueError("Usage of disallowed function/method: " + ast.unparse(node))
-
-            # If all checks pass, return the original query
-            return ast.unparse(tree)
+                return restrict_code(query, self.frozen_functions, self.frozen_attrs)
+            # Parse the code to an AST and return the original query
+            return ast.unparse(ast.parse(query))
 
         except Exception as e:
             # Save exception info in the namespace to retrieve it later in the main thread.
             self.namespace['_preprocess_info'] = (type(e), e, e.__traceback__)
             return ""
 
-    def execute_last_line(self, last_line):
-        output_io = io.StringIO()
-        if self.redirect_output:
-            sys.stdout = output_io  # Redirect stdout to capture print statements
-        output = ""
-        if is_expression(last_line):
-            eval_output = eval(last_line, self.namespace)
-            if eval_output is not None:
-                output += str(eval_output)
-        else:
-            exec(last_line, self.namespace)
-        printed_output = output_io.getvalue()
-        if printed_output:
-            output += printed_output
-            output_io.seek(0)
-            output_io.truncate(0)
-        return output
+    def start_worker(self):
+        context = multiprocessing.get_context("spawn")
+        self.connection, worker_connection = context.Pipe()
+        # not a daemon, the code may create agents that start their own worker
+        self.worker = context.Process(target=run_executor, args=(worker_connection, self.redirect_output, self.max_output_chars, self.setup_code))
+        self.worker.start()
+        worker_connection.close()
+        # stop the worker at exit, before multiprocessing joins its non-daemonic children
+        self.worker_cleanup = functools.partial(stop_process, self.worker, self.connection)
+        atexit.register(self.worker_cleanup)
 
-    def execute_code_blocks(self, blocks):
-        output_io = io.StringIO()
-        if self.redirect_output:
-            sys.stdout = output_io
-        output = ""
-        for block in blocks:
-            exec(block, self.namespace)
-        printed_output = output_io.getvalue()
-        if printed_output:
-            output += printed_output
-            output_io.seek(0)
-            output_io.truncate(0)
-        return output
-
-    def run_code(self, query: str) -> dict:
-        output = ""
-        code_blocks = split_code_blocks(query)
-        last_line = code_blocks.pop(-1) if len(code_blocks) > 0 else ""
-        original_stdout = sys.stdout
+    def stop_worker(self):
+        if self.worker_cleanup is not None:
+            atexit.unregister(self.worker_cleanup)
+            self.worker_cleanup()
+        self.worker = None
+        self.connection = None
+        self.worker_cleanup = None
+
+    def run_with_return(self, query: str, restricted: bool = False) -> ToolResult:
+        # the pipe carries one request at a time
+        with self.worker_lock:
+            return self.run_in_worker(query, restricted)
+
+    def run_in_worker(self, query: str, restricted: bool = False) -> ToolResult:
+        from creator.callbacks import streaming_stdout
+        if self.worker is None or not self.worker.is_alive():
+            self.stop_worker()
+            self.start_worker()
+        deadline = time.monotonic() + self.timeout
         try:
-            if len(code_blocks) > 0:
-                output += self.execute_code_blocks(code_blocks)
-            if last_line:
-                output += self.execute_last_line(last_line)
+            self.connection.send((query, restricted))
+            # Wait for the worker to finish or to timeout, replaying the output of agents running in the worker.
+            while time.monotonic() < deadline and self.connection.poll(max(deadline - time.monotonic(), 0)):
+                kind, *payload = self.connection.recv()
+                if kind == "result":
+                    return orjson.loads(payload[0])
+                manager_name, method, args, kwargs = payload
+                getattr(getattr(streaming_stdout, manager_name), method)(*args, **kwargs)
+        except (EOFError, BrokenPipeError):
+            # The worker died while running the code (e.g., the code called exit()).
+            self.stop_worker()
+            return {"status": "error", "stdout": "", "stderr": "Python worker exited unexpectedly, the namespace has been reset"}
+        except BaseException:
+            # An interrupted exchange (e.g., KeyboardInterrupt) leaves the pending reply in the pipe, start over.
+            self.stop_worker()
+            raise
 
-            self.namespace.pop("_stdout_info", None)
-            if output:
-                self.namespace['_stdout_info'] = output
-        except Exception as e:
-            # Save exception info in the namespace to retrieve it later in the main thread.
-            self.namespace['_exec_info'] = (type(e), e, e.__traceback__)
-        finally:
-            sys.stdout = original_stdout
-
-    def run_with_return(self, query: str) -> dict[str, str]:
-        # Run the code in a separate thread and wait for it to finish or to timeout.
-        thread = threading.Thread(target=self.run_code, args=(query,))
-        thread.start()
-        thread.join(timeout=self.timeout)
-
-        stdout = self.namespace.get('_stdout_info', "")
-        # If the thread is still alive after the timeout, it is stuck in a long-running operation (e.g., an infinite loop).
-        if thread.is_alive():
-            # If possible, kill the thread. Note: This is not always safe and may result in inconsistencies.
-            # ... add any thread termination logic here ...
-            return {"status": "error", "stdout": stdout, "stderr": "Code execution timed out"}
-
-        # Retrieve and clear the saved exception info from the namespace.
-        exec_info = self.namespace.pop('_exec_info', None)
-        if exec_info:
-            # Format and return the exception info.
-            tb_lines = traceback.format_exception(*exec_info)
-            return {"status": "error", "stdout": stdout, "stderr": "".join(tb_lines)}
-
-        return {"status": "success", "stdout": stdout, "stderr": ""}
+        # The worker is stuck in a long-running operation (e.g., an infinite loop), kill it and start over on the next run.
+        self.stop_worker()
+        return {"status": "error", "stdout": "", "stderr": "Code execution timed out, the namespace has been reset"}
 
     def _run(self,
              code: str,
              run_manager: Optional[CallbackManagerForToolRun] = None
-             ) -> dict[str, str]:
+             ) -> ToolResult:
         # Preprocess the query
         query = self.preprocess(code)
 
@@ -169,7 +301,8 @@ class SafePythonInterpreter(StructuredTool):
             tb_lines = traceback.format_exception(*preprocess_info)
             return {"status": "error", "stdout": "", "stderr": "".join(tb_lines)}
 
-        return self.run_with_return(query)
+        # the code passed the checks of the setup allow list, so it runs with the safe builtins only
+        return self.run_with_return(query, restricted=getattr(self, "setup_done", False))
 
     def to_function_schema(self):
         function_schema = format_tool_to_openai_function(self)
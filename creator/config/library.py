@@ -33,6 +33,8 @@ _model = yaml_config.get("MODEL_NAME", "gpt-3.5-turbo-16k-0613")
 _temperature = yaml_config.get("TEMPERATURE", 0)
 _run_human_confirm = yaml_config.get("RUN_HUMAN_CONFIRM", False)
 _use_stream_callback = yaml_config.get("USE_STREAM_CALLBACK", True)
+_max_concurrent_llm = yaml_config.get("MAX_CONCURRENT_LLM", 8)
+_speculative_prefetch = yaml_config.get("SPECULATIVE_PREFETCH", False)
 _build_in_skill_library_dir = yaml_config.get("BUILD_IN_SKILL_LIBRARY_DIR", "skill_library/open-creator/")
 _build_in_skill_library_dir = os.path.join(project_dir, _build_in_skill_library_dir)
 
@@ -72,6 +74,8 @@ class LibraryConfig(BaseModel):
     build_in_skill_config: dict = build_in_skill_config
     run_human_confirm: bool = _run_human_confirm
     use_stream_callback: bool = _use_stream_callback
+    max_concurrent_llm: int = _max_concurrent_llm
+    speculative_prefetch: bool = _speculative_prefetch
     code_interpreter: CodeInterpreter = CodeInterpreter()
 
     # prompt paths
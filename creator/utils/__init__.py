@@ -9,8 +9,10 @@ from .user_info import get_user_info
 from .load_prompt import load_system_prompt
 from .printer import print
 from .code_split import split_code_blocks
-from .valid_code import is_valid_code, is_expression
-from .tips_utils import remove_tips
+from .valid_code import is_valid_code, is_expression, compile_exec, try_compile_eval
+from .tips_utils import remove_tips, ERROR_PATTERN
+from .json_codec import dump_json, load_json
+from .message_convert import to_langchain_message, to_openai_message
 
 
 __all__ = [
@@ -27,5 +29,12 @@ __all__ = [
     "split_code_blocks",
     "is_valid_code",
     "is_expression",
-    "remove_tips"
+    "compile_exec",
+    "try_compile_eval",
+    "remove_tips",
+    "ERROR_PATTERN",
+    "dump_json",
+    "load_json",
+    "to_langchain_message",
+    "to_openai_message"
 ]
@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=128)
 def split_code_blocks(code: str):
     lines = code.strip().split('\n')
     i = len(lines) - 1
@@ -19,4 +23,5 @@ def split_code_blocks(code: str):
     if i >= 0:
         codes.append("\n".join(lines[:i+1]))
     
-    return codes[::-1]
+    # cached, so hand out an immutable tuple
+    return tuple(codes[::-1])
@@ -0,0 +1,15 @@
+import orjson
+from langchain.output_parsers.json import parse_partial_json
+
+
+def dump_json(obj) -> str:
+    # orjson never escapes non-ascii, same as json.dumps(..., ensure_ascii=False)
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def load_json(s: str):
+    # function call arguments are almost always well-formed, only fall back to the partial parser on failure
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        return parse_partial_json(s)
@@ -1,3 +1,7 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
 def load_system_prompt(prompt_path):
     with open(prompt_path, encoding='utf-8') as f:
         prompt = f.read()
@@ -0,0 +1,48 @@
+from langchain.adapters.openai import convert_dict_to_message, convert_message_to_dict
+from langchain.schema.messages import AIMessage, AIMessageChunk, FunctionMessage, HumanMessage, SystemMessage
+
+
+# The agents only exchange these message shapes, so they are converted directly and
+# anything else falls back to the generic langchain adapter.
+ROLE_TO_MESSAGE_CLASS = {
+    "user": HumanMessage,
+    "system": SystemMessage,
+}
+MESSAGE_CLASS_TO_ROLE = {
+    HumanMessage: "user",
+    SystemMessage: "system",
+    AIMessage: "assistant",
+    AIMessageChunk: "assistant",
+    FunctionMessage: "function",
+}
+
+
+def to_langchain_message(message: dict):
+    role = message["role"]
+    if role == "assistant":
+        function_call = message.get("function_call")
+        additional_kwargs = {"function_call": dict(function_call)} if function_call else {}
+        return AIMessage(content=message.get("content") or "", additional_kwargs=additional_kwargs)
+    if role == "function":
+        return FunctionMessage(content=message["content"], name=message["name"])
+    message_class = ROLE_TO_MESSAGE_CLASS.get(role)
+    if message_class is None:
+        return convert_dict_to_message(message)
+    return message_class(content=message["content"])
+
+
+def to_openai_message(message) -> dict:
+    role = MESSAGE_CLASS_TO_ROLE.get(type(message))
+    if role is None:
+        return convert_message_to_dict(message)
+    message_dict = {"role": role, "content": message.content}
+    if role == "assistant" and "function_call" in message.additional_kwargs:
+        message_dict["function_call"] = message.additional_kwargs["function_call"]
+        # OpenAI expects a null content alongside a function call
+        if message_dict["content"] == "":
+            message_dict["content"] = None
+    elif role == "function":
+        message_dict["name"] = message.name
+    if "name" in message.additional_kwargs:
+        message_dict["name"] = message.additional_kwargs["name"]
+    return message_dict
@@ -15,7 +15,7 @@ def truncate_output(tool_result, max_output_chars=1000):
         if not truncated:
             tool_result["stderr"] += f"\nOutput of `run_code` function truncated. The last {max_output_chars} characters are shown\n"
         stderr_str = tool_result["stderr"]
-    if len(stdout_str+stderr_str) > max_output_chars:
+    if len(stdout_str) + len(stderr_str) > max_output_chars:
         tool_result["stderr"] = "..." + stderr_str[-max_output_chars:]
         if not truncated:
             tool_result["stderr"] += f"\nOutput of `run_code` function truncated. The last {max_output_chars} characters are shown\n"
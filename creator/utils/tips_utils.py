@@ -1,3 +1,8 @@
+import re
+
+
+# searched case-insensitively so the stderr is never lowercased into a copy
+ERROR_PATTERN = re.compile(r"error", re.IGNORECASE)
 
 
 def remove_tips(messages):
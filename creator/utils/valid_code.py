@@ -1,5 +1,6 @@
 import re
 import ast
+from functools import lru_cache
 
 
 def is_valid_variable_name(name: str) -> bool:
@@ -40,5 +41,18 @@ def is_valid_code(code: str, namespace: dict) -> bool:
             is_compilable(code, "exec"))
 
 
+@lru_cache(maxsize=512)
+def compile_exec(code: str):
+    return compile(code, "<cell>", "exec")
+
+
+@lru_cache(maxsize=512)
+def try_compile_eval(code: str):
+    try:
+        return compile(code, "<cell>", "eval")
+    except SyntaxError:
+        return None
+
+
 def is_expression(code: str):
-    return is_compilable(code, "eval")
+    return try_compile_eval(code) is not None